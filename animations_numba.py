@@ -0,0 +1,45 @@
+import numpy as np
+from numba import njit
+
+# -----------------------------
+# Frame kernels (compiled)
+# -----------------------------
+@njit(cache=True)
+def bad_frame(heat, out_packed, red_c, orange_c, scale_lut):
+    """
+    One frame of the hellfire: cool/flicker the heat, maybe flare,
+    then pack each pixel as GRB into out_packed.
+    """
+    n = len(heat)
+
+    for i in range(n):
+        heat[i] += np.random.randint(-35, 26)
+        heat[i] -= np.random.randint(8, 19)
+        heat[i] = max(0, min(255, heat[i]))
+
+    if np.random.random() < 0.25:
+        p = np.random.randint(0, n)
+        heat[p] = min(255, heat[p] + np.random.randint(170, 231))
+        if p > 0:
+            heat[p-1] = min(255, heat[p-1] + np.random.randint(70, 141))
+        if p < n - 1:
+            heat[p+1] = min(255, heat[p+1] + np.random.randint(70, 141))
+
+    for i in range(n):
+        h = heat[i]
+        if h < 210:
+            c = red_c
+            scale = min(255, int(h * 1.5))
+        else:
+            c = orange_c
+            scale = h
+
+        g = (c >> 16) & 0xFF
+        r = (c >> 8) & 0xFF
+        b = c & 0xFF
+        # widen the uint8 LUT entries before shifting
+        out_packed[i] = (int(scale_lut[g, scale]) << 16) | (int(scale_lut[r, scale]) << 8) | int(scale_lut[b, scale])
+
+def warm_up(num_leds, red_c, orange_c, scale_lut):
+    # compile (or load from cache) before the first show needs it
+    bad_frame(np.zeros(num_leds, np.int32), np.empty(num_leds, np.uint32), red_c, orange_c, scale_lut)
@@ -1,22 +1,32 @@
-import time
-from rpi_ws281x import PixelStrip, Color
+import numpy as np
+from rpi_ws281x import PixelStrip
 
-LED_COUNT=50
+LED_COUNT = 50
 LED_PIN = 18
-LED_REQ_HZ = 800000
+LED_FREQ_HZ = 800000
 LED_DMA = 10
 LED_BRIGHTNESS = 255
 LED_INVERT = False
 LED_CHANNEL = 0
 
 strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
-strip.begin
+strip.begin()
 
-def set_led(index, r, g, b):
-    strip.setPixelColor(index, Color(r,g,b))
-    pixels.show()
+def _grb(g, r, b):
+    return (g << 16) | (r << 8) | b
 
-set_led(0, (255, 0, 0))
-set_led(1, (0, 255, 0))
-set_led(2, (0, 0, 255))
+def set_leds(arr):
+    # same whole-buffer write server.py uses for animation frames
+    led_data = getattr(strip, "_led_data", None)
+    if led_data is not None:
+        # rpi_ws281x 4.x: one slice store into the _LED_Data wrapper
+        led_data[0:len(arr)] = arr.tolist()
+    else:
+        # 5.x dropped _led_data
+        for i, c in enumerate(arr.tolist()):
+            strip.setPixelColor(i, c)
+    strip.show()
 
+arr = np.zeros(LED_COUNT, np.uint32)
+arr[:3] = [_grb(0, 255, 0), _grb(255, 0, 0), _grb(0, 0, 255)]  # red, green, blue
+set_leds(arr)
@@ -1,12 +1,21 @@
-from flask import Flask, request, render_template_string
-from rpi_ws281x import PixelStrip, Color
-import threading, json, os, tempfile, time, random
+from flask import Flask, Response, request, render_template_string, jsonify, abort
+from rpi_ws281x import PixelStrip
+import threading, queue, os, mmap, time, gzip, hashlib
+import numpy as np
+import orjson
+from itertools import count
+from animations_numba import bad_frame, warm_up
 
 # -----------------------------
 # Config
 # -----------------------------
 NUM_LEDS = 20
-STATE_PATH = "/home/pi/led_state.json"
+STATE_PATH = "/home/pi/led_state.bin"
+LEGACY_STATE_PATH = "/home/pi/led_state.json"
+
+LABEL_MAX = 60
+LABEL_SLOT = LABEL_MAX * 4   # worst-case UTF-8 bytes for LABEL_MAX chars
+STATE_SIZE = NUM_LEDS + NUM_LEDS * LABEL_SLOT
 
 LED_PIN = 18
 LED_FREQ_HZ = 800000
@@ -20,11 +29,16 @@ LED_CHANNEL = 0
 # -----------------------------
 labels = [f"LED {i}" for i in range(NUM_LEDS)]
 modes  = ["off"] * NUM_LEDS
-state_version = 0
+# bumped under version_cond, so the published version only ever goes up
+_ver = count(1)
+state_version = next(_ver)
+state_mm = None
 
 state_lock = threading.Lock()
-led_hw_lock = threading.Lock()
-show_lock = threading.Lock()
+_last_rendered = [None] * NUM_LEDS   # modes currently on the strip; led_actor only
+led_queue = queue.Queue()   # ("render", None) / ("anim", fn), consumed by led_actor
+save_event = threading.Event()
+version_cond = threading.Condition()
 
 # -----------------------------
 # Flask
@@ -45,62 +59,159 @@ strip = PixelStrip(
 )
 strip.begin()
 
+# -----------------------------
+# Colors (GRB)
+# -----------------------------
+def _grb(g, r, b):
+    return (g << 16) | (r << 8) | b
+
+OFF    = _grb(0, 0, 0)
+WHITE  = _grb(255, 255, 255)
+BLUE   = _grb(0, 0, 255)
+RED    = _grb(0, 255, 0)
+ORANGE = _grb(80, 255, 0)
+
+# SCALE[c, lvl] == (c * lvl) // 255, so pixel scaling is a lookup, not a divide
+SCALE = (np.arange(256)[:, None] * np.arange(256) // 255).astype(np.uint8)
+
+MODE_COLORS = {
+    "off":    OFF,
+    "white":  WHITE,
+    "purple": _grb(0, 128, 128),
+    "yellow": _grb(255, 255, 0),
+    "red":    RED,
+}
+
+# on-disk mode encoding; "off" must stay 0 so a zeroed file means all off
+MODE_NAMES = list(MODE_COLORS)
+MODE_TO_BYTE = {m: i for i, m in enumerate(MODE_NAMES)}
+
 # -----------------------------
 # Helpers
 # -----------------------------
 def bump_version():
     global state_version
-    state_version += 1
-
-def color_for_mode(mode):
-    # GRB order
-    if mode == "off":    return Color(0, 0, 0)
-    if mode == "white":  return Color(255, 255, 255)
-    if mode == "purple": return Color(0, 128, 128)
-    if mode == "yellow": return Color(255, 255, 0)
-    if mode == "red":    return Color(0, 255, 0)
-    return Color(0, 0, 0)
-
-def render_leds():
+    with version_cond:
+        state_version = next(_ver)
+        version_cond.notify_all()
+
+def blit(packed):
+    """
+    Write a whole frame of GRB-packed uint32 pixels into the strip buffer.
+    Caller still does strip.show().
+    """
+    led_data = getattr(strip, "_led_data", None)
+    if led_data is not None:
+        # rpi_ws281x 4.x: one slice store into the _LED_Data wrapper
+        led_data[0:len(packed)] = packed.tolist()
+    else:
+        # 5.x dropped _led_data (and strip[a:b] = list would fill every pixel)
+        for i, c in enumerate(packed.tolist()):
+            strip.setPixelColor(i, c)
+
+def snapshot_modes():
     with state_lock:
-        current_modes = list(modes)
-    with led_hw_lock:
-        for i in range(NUM_LEDS):
-            strip.setPixelColor(i, color_for_mode(current_modes[i]))
-        strip.show()
+        return list(modes)
+
+def render_leds(current_modes):
+    # LED actor thread only; only pixels whose mode changed are rewritten
+    for i in range(NUM_LEDS):
+        m = current_modes[i]
+        if m != _last_rendered[i]:
+            strip.setPixelColor(i, MODE_COLORS.get(m, OFF))
+            _last_rendered[i] = m
+    strip.show()
+
+def invalidate_render():
+    # a show scribbled over the strip; next render_leds must repaint everything
+    _last_rendered[:] = [None] * NUM_LEDS
+
+def open_state():
+    """
+    Map the binary state file: NUM_LEDS mode bytes, then one NUL-padded
+    UTF-8 slot of LABEL_SLOT bytes per label. Returns True if it was
+    (re)created and holds no state yet.
+    """
+    global state_mm
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    fd = os.open(STATE_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fresh = os.fstat(fd).st_size != STATE_SIZE
+        if fresh:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, STATE_SIZE)
+        state_mm = mmap.mmap(fd, STATE_SIZE)
+    finally:
+        os.close(fd)
+    return fresh
+
+def store_mode(i, mode):
+    # lives in the mmap right away; call flush_modes() once state_lock is released
+    state_mm[i] = MODE_TO_BYTE.get(mode, 0)
+
+def flush_modes():
+    # modes all sit in the first page, so this is one tiny msync
+    state_mm.flush(0, NUM_LEDS)
+
+def store_label(i, label):
+    # lives in the mmap right away; reaches disk on the next save_state()
+    off = NUM_LEDS + i * LABEL_SLOT
+    state_mm[off:off + LABEL_SLOT] = label.encode()[:LABEL_SLOT].ljust(LABEL_SLOT, b"\0")
 
 def load_state():
     global labels, modes
-    if not os.path.exists(STATE_PATH):
+    existed = os.path.exists(STATE_PATH)
+    if open_state():
+        # only a brand-new file imports the old JSON state; a resized one
+        # (NUM_LEDS/LABEL_MAX changed) starts from defaults
+        if not existed and os.path.exists(LEGACY_STATE_PATH):
+            with open(LEGACY_STATE_PATH, "rb") as f:
+                data = orjson.loads(f.read())
+            old_labels = data.get("labels", [])
+            old_modes  = data.get("modes", [])
+            # pad/truncate to the current NUM_LEDS
+            labels = [
+                old_labels[i][:LABEL_MAX] if i < len(old_labels) and isinstance(old_labels[i], str) else f"LED {i}"
+                for i in range(NUM_LEDS)
+            ]
+            modes = [
+                old_modes[i] if i < len(old_modes) and old_modes[i] in MODE_NAMES else "off"
+                for i in range(NUM_LEDS)
+            ]
+        for i in range(NUM_LEDS):
+            store_mode(i, modes[i])
+            store_label(i, labels[i])
+        save_state()
         return
-    with open(STATE_PATH, "r") as f:
-        data = json.load(f)
-    labels = data.get("labels", labels)
-    modes  = data.get("modes", modes)
 
-def save_state():
-    data = {"labels": labels, "modes": modes}
-    d = os.path.dirname(STATE_PATH)
-    os.makedirs(d, exist_ok=True)
-    fd, tmp = tempfile.mkstemp(dir=d, prefix=".led_state_", text=True)
-    with os.fdopen(fd, "w") as f:
-        json.dump(data, f)
-    os.replace(tmp, STATE_PATH)
+    data = state_mm[:]
+    modes = [MODE_NAMES[b] if b < len(MODE_NAMES) else "off" for b in data[:NUM_LEDS]]
+    labels = [
+        data[NUM_LEDS + i * LABEL_SLOT:NUM_LEDS + (i + 1) * LABEL_SLOT].rstrip(b"\0").decode("utf-8", "replace")
+        for i in range(NUM_LEDS)
+    ]
 
-# -----------------------------
-# Colors (GRB)
-# -----------------------------
-OFF    = Color(0, 0, 0)
-WHITE  = Color(255, 255, 255)
-BLUE   = Color(0, 0, 255)
-RED    = Color(0, 255, 0)
-ORANGE = Color(80, 255, 0)
+def save_state():
+    state_mm.flush()
+
+def state_flusher():
+    # coalesce bursts of edits (label typing) into one write
+    while True:
+        save_event.wait()
+        save_event.clear()
+        time.sleep(0.5)
+        try:
+            save_state()
+        except Exception:
+            app.logger.exception("failed to save state")
 
 # -----------------------------
 # Animations
 # -----------------------------
 def chase_fill(color, delay_s):
     for i in range(NUM_LEDS):
+        if preempted():
+            return
         strip.setPixelColor(i, color)
         strip.show()
         time.sleep(delay_s)
@@ -117,38 +228,49 @@ def show_good_team_wins_10s():
     Blue-heavy fireworks with white highlights
     """
     duration = 10.0
-    start = time.time()
-
-    levels = [0] * NUM_LEDS
-    colors = [BLUE] * NUM_LEDS
-
-    with led_hw_lock:
-        while time.time() - start < duration:
-            for _ in range(random.randint(3, 7)):
-                idx = random.randrange(NUM_LEDS)
-                levels[idx] = random.randint(170, 255)
-                colors[idx] = BLUE if random.random() < 0.8 else WHITE
-
-            if random.random() < 0.22:
-                center = random.randrange(NUM_LEDS)
-                burst_color = BLUE if random.random() < 0.85 else WHITE
-                for d in (-2, -1, 0, 1, 2):
-                    j = center + d
-                    if 0 <= j < NUM_LEDS:
-                        levels[j] = max(levels[j], random.randint(190, 255))
-                        colors[j] = burst_color
-
-            for i in range(NUM_LEDS):
-                levels[i] = max(0, levels[i] - random.randint(30, 60))
-                lvl = levels[i]
-                c = colors[i]
-                g = (c >> 16) & 0xFF
-                r = (c >> 8) & 0xFF
-                b = c & 0xFF
-                strip.setPixelColor(i, Color((g * lvl)//255, (r * lvl)//255, (b * lvl)//255))
-
-            strip.show()
-            time.sleep(0.045)
+
+    levels = np.zeros(NUM_LEDS, dtype=np.int16)
+    # every pixel is either BLUE or WHITE
+    is_white = np.zeros(NUM_LEDS, dtype=bool)
+
+    # bind hot-loop callables to locals to skip global/attribute lookups
+    np_randint = np.random.randint
+    np_rand = np.random.random
+
+    start = next_t = time.monotonic()
+    while time.monotonic() - start < duration:
+        if preempted():
+            return
+        n = np_randint(3, 8)
+        idx = np_randint(0, NUM_LEDS, n)
+        levels[idx] = np_randint(170, 256, n)
+        is_white[idx] = np_rand(n) < 0.2
+
+        if np_rand() < 0.22:
+            center = np_randint(NUM_LEDS)
+            lo = max(0, center - 2)
+            hi = min(NUM_LEDS, center + 3)
+            levels[lo:hi] = np.maximum(levels[lo:hi], np_randint(190, 256, size=hi - lo, dtype=np.int16))
+            is_white[lo:hi] = np_rand() >= 0.85
+
+        # one RNG call for the whole strip; levels never exceed 255, so only floor at 0
+        levels -= np_randint(30, 61, size=NUM_LEDS, dtype=np.int16)
+        np.maximum(levels, 0, out=levels)
+
+        # blue tracks the level exactly (SCALE[255, lvl] == lvl); white adds equal green and red
+        lvl = levels.astype(np.uint32)
+        w = lvl * is_white
+        packed = (w << 16) | (w << 8) | lvl
+
+        blit(packed)
+        strip.show()
+        # subtract frame compute time from the sleep so the rate doesn't drift;
+        # after a stall, resync rather than bursting catch-up frames
+        next_t += 0.045
+        now = time.monotonic()
+        if now - next_t > 0.045:
+            next_t = now
+        time.sleep(max(0, next_t - now))
 
 def show_bad_team_wins_10s():
     """
@@ -156,80 +278,115 @@ def show_bad_team_wins_10s():
     With cooling so it never gets stuck orange.
     """
     duration = 10.0
-    start = time.time()
-
-    heat = [random.randint(5, 70) for _ in range(NUM_LEDS)]
-
-    with led_hw_lock:
-        while time.time() - start < duration:
-            for i in range(NUM_LEDS):
-                heat[i] += random.randint(-35, 25)
-                heat[i] -= random.randint(8, 18)
-                heat[i] = max(0, min(255, heat[i]))
-
-            if random.random() < 0.25:
-                p = random.randrange(NUM_LEDS)
-                heat[p] = min(255, heat[p] + random.randint(170, 230))
-                if p > 0:
-                    heat[p-1] = min(255, heat[p-1] + random.randint(70, 140))
-                if p < NUM_LEDS - 1:
-                    heat[p+1] = min(255, heat[p+1] + random.randint(70, 140))
-
-            for i in range(NUM_LEDS):
-                h = heat[i]
-                if h < 210:
-                    c = RED
-                    scale = int(h * 1.5)
-                else:
-                    c = ORANGE
-                    scale = h
-
-                g = (c >> 16) & 0xFF
-                r = (c >> 8) & 0xFF
-                b = c & 0xFF
-                strip.setPixelColor(i, Color((g * scale)//255, (r * scale)//255, (b * scale)//255))
-
-            strip.show()
-            time.sleep(0.09)
-
-def run_show_and_restore(fn):
-    if not show_lock.acquire(blocking=False):
-        return
-    try:
-        fn()
-    finally:
-        render_leds()
-        show_lock.release()
+
+    heat = np.random.randint(5, 71, NUM_LEDS).astype(np.int32)
+    packed = np.empty(NUM_LEDS, np.uint32)
+
+    start = next_t = time.monotonic()
+    while time.monotonic() - start < duration:
+        if preempted():
+            return
+        bad_frame(heat, packed, RED, ORANGE, SCALE)
+        blit(packed)
+        strip.show()
+        # subtract frame compute time from the sleep so the rate doesn't drift;
+        # after a stall, resync rather than bursting catch-up frames
+        next_t += 0.09
+        now = time.monotonic()
+        if now - next_t > 0.09:
+            next_t = now
+        time.sleep(max(0, next_t - now))
+
+def preempted():
+    # a show stops between frames as soon as anything else wants the strip
+    return not led_queue.empty()
+
+def led_actor():
+    """
+    Sole owner of the strip. Paints the current modes and runs shows;
+    after a show (finished or preempted) the modes are repainted.
+    """
+    while True:
+        kind, arg = led_queue.get()
+        try:
+            if kind == "anim":
+                try:
+                    arg()
+                finally:
+                    invalidate_render()
+                    render_leds(snapshot_modes())
+            else:
+                # snapshot at paint time so out-of-order requests can't paint stale modes
+                render_leds(snapshot_modes())
+        except Exception:
+            app.logger.exception("LED %s failed", kind)
+
+def queue_render():
+    led_queue.put(("render", None))
+
+def queue_show(fn):
+    led_queue.put(("anim", fn))
 
 # -----------------------------
 # Routes
 # -----------------------------
+def read_indexed_body():
+    """
+    Parse a {"index": ...} JSON body straight from the raw bytes with orjson
+    (bypassing request.json). Malformed bodies or out-of-range indexes get a 400.
+    """
+    try:
+        d = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        abort(400)
+    i = d.get("index") if isinstance(d, dict) else None
+    if type(i) is not int or not 0 <= i < NUM_LEDS:
+        abort(400)
+    return d, i
+
 @app.route("/")
 def index():
+    # skeleton never changes at runtime, so the ETag is just its content hash
+    if "gzip" in request.accept_encodings:
+        resp = Response(INDEX_GZ, mimetype="text/html")
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.set_etag(INDEX_ETAG + "-gz")
+    else:
+        resp = Response(INDEX_HTML, mimetype="text/html")
+        resp.set_etag(INDEX_ETAG)
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp.make_conditional(request)
+
+@app.route("/state")
+def state():
     with state_lock:
-        return render_template_string(
-            HTML,
-            labels=list(labels),
-            modes=list(modes),
-            num_leds=NUM_LEDS
-        )
+        return jsonify(labels=labels, modes=modes, version=state_version)
 
 @app.route("/set_mode", methods=["POST"])
 def set_mode():
-    d = request.json
+    d, i = read_indexed_body()
+    mode = d.get("mode")
+    if not isinstance(mode, str) or mode not in MODE_TO_BYTE:
+        abort(400)
     with state_lock:
-        modes[int(d["index"])] = d["mode"]
-    render_leds()
-    save_state()
+        modes[i] = mode
+        store_mode(i, mode)
+    flush_modes()
+    queue_render()
     bump_version()
     return "ok"
 
 @app.route("/set_label", methods=["POST"])
 def set_label():
-    d = request.json
+    d, i = read_indexed_body()
+    label = d.get("label")
+    if not isinstance(label, str):
+        abort(400)
+    label = label[:LABEL_MAX]
     with state_lock:
-        labels[int(d["index"])] = d["label"][:60]
-    save_state()
+        labels[i] = label
+        store_label(i, label)
+    save_event.set()
     bump_version()
     return "ok"
 
@@ -238,8 +395,9 @@ def clear_all():
     with state_lock:
         for i in range(NUM_LEDS):
             modes[i] = "off"
-    render_leds()
-    save_state()
+            store_mode(i, "off")
+    flush_modes()
+    queue_render()
     bump_version()
     return "ok"
 
@@ -248,28 +406,41 @@ def reset_labels():
     with state_lock:
         for i in range(NUM_LEDS):
             labels[i] = f"LED {i}"
-    save_state()
+            store_label(i, labels[i])
+    save_event.set()
     bump_version()
     return "ok"
 
 @app.route("/light_display", methods=["POST"])
 def light_display():
-    threading.Thread(target=lambda: run_show_and_restore(light_display_2s), daemon=True).start()
+    queue_show(light_display_2s)
     return "ok"
 
 @app.route("/good_team_wins", methods=["POST"])
 def good_team_wins():
-    threading.Thread(target=lambda: run_show_and_restore(show_good_team_wins_10s), daemon=True).start()
+    queue_show(show_good_team_wins_10s)
     return "ok"
 
 @app.route("/bad_team_wins", methods=["POST"])
 def bad_team_wins():
-    threading.Thread(target=lambda: run_show_and_restore(show_bad_team_wins_10s), daemon=True).start()
+    queue_show(show_bad_team_wins_10s)
     return "ok"
 
-@app.route("/state_version")
-def version():
-    return str(state_version)
+@app.route("/events")
+def events():
+    def gen():
+        last = None
+        while True:
+            with version_cond:
+                version_cond.wait_for(lambda: state_version != last, timeout=15)
+                v = state_version
+            if v == last:
+                # keepalive so dead clients get noticed and their thread freed
+                yield ": ping\n\n"
+                continue
+            last = v
+            yield f"data: {v}\n\n"
+    return Response(gen(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # -----------------------------
 # HTML
@@ -335,20 +506,13 @@ HTML = """
 
 <div id="rows">
 {% for i in range(num_leds) %}
-  <div class="row" data-index="{{i}}">
-    <span>
-      {% if modes[i]=="off" %}⚫
-      {% elif modes[i]=="white" %}⚪
-      {% elif modes[i]=="purple" %}🟣
-      {% elif modes[i]=="yellow" %}🟡
-      {% elif modes[i]=="red" %}🔴
-      {% endif %}
-    </span>
-
-    <input value="{{labels[i]}}" oninput="setLabel({{i}}, this.value); applyHideFilter();">
+  <div class="row" id="row-{{i}}" data-index="{{i}}">
+    <span></span>
+
+    <input oninput="setLabel({{i}}, this.value); applyHideFilter();">
     <select onchange="setMode({{i}}, this.value)">
       {% for m in ["off","white","purple","yellow","red"] %}
-        <option value="{{m}}" {% if modes[i]==m %}selected{% endif %}>{{m}}</option>
+        <option value="{{m}}">{{m}}</option>
       {% endfor %}
     </select>
   </div>
@@ -367,7 +531,10 @@ HTML = """
 </div>
 
 <script>
+const MODE_ICONS = {off:"⚫", white:"⚪", purple:"🟣", yellow:"🟡", red:"🔴"};
 let lastVersion = null;
+let shownLabels = [];
+let shownModes = [];
 let hideDefaults = (localStorage.getItem("hideDefaults") === "1");
 
 function isDefaultOrBlank(label, index){
@@ -402,16 +569,28 @@ function toggleHideDefaults(){
   applyHideFilter();
 }
 
-// restore state on load + preserve scroll
-window.addEventListener("load", ()=>{
-  updateHideButton();
+// only touch rows that changed; never clobber the input being typed in
+function applyState(s){
+  for(let i = 0; i < s.modes.length; i++){
+    const row = document.getElementById("row-" + i);
+    if(!row) continue;
+    if(s.modes[i] !== shownModes[i]){
+      row.querySelector("select").value = s.modes[i];
+      row.querySelector("span").textContent = MODE_ICONS[s.modes[i]] || "";
+      shownModes[i] = s.modes[i];
+    }
+    const input = row.querySelector("input");
+    if(s.labels[i] !== shownLabels[i] && input !== document.activeElement){
+      input.value = s.labels[i];
+      shownLabels[i] = s.labels[i];
+    }
+  }
   applyHideFilter();
+}
 
-  const y = sessionStorage.getItem("scrollY");
-  if(y !== null){
-    window.scrollTo(0, parseInt(y,10) || 0);
-    sessionStorage.removeItem("scrollY");
-  }
+window.addEventListener("load", ()=>{
+  updateHideButton();
+  poll();
 });
 
 function setMode(i, m){
@@ -426,15 +605,17 @@ function setLabel(i, l){
 
 function clearAll(){
   if(!confirm("Clear ALL LEDs (set them all to off)?")) return;
-  fetch("/clear_all",{method:"POST"}).then(()=>location.reload());
+  fetch("/clear_all",{method:"POST"}).then(poll);
 }
 
 function resetLabels(){
   if(!confirm("Reset ALL label names?")) return;
   fetch("/reset_labels",{method:"POST"}).then(()=>{
-    // NEW: after resetting labels, force all rows visible
+    // after resetting labels, force all rows visible
+    hideDefaults = false;
     localStorage.setItem("hideDefaults", "0");
-    location.reload();
+    updateHideButton();
+    poll();
   });
 }
 
@@ -452,34 +633,36 @@ function badTeamWins(){
 
 async function poll(){
   try{
-    const v = await fetch("/state_version",{cache:"no-store"}).then(r=>r.text());
-    if(lastVersion === null){ lastVersion = v; return; }
-    if(v !== lastVersion){
-      const active = document.activeElement;
-      if(active && active.tagName === "INPUT"){
-        lastVersion = v;
-        return;
-      }
-      sessionStorage.setItem("scrollY", String(window.scrollY));
-      location.reload();
-    }
+    const s = await fetch("/state",{cache:"no-store"}).then(r=>r.json());
+    if(String(s.version) === lastVersion) return;
+    lastVersion = String(s.version);
+    applyState(s);
   }catch(e){}
 }
 
-setInterval(poll,1000);
+const events = new EventSource("/events");
+events.onmessage = e => { if (e.data !== lastVersion) poll(); };
 </script>
 
 </body>
 </html>
 """
 
+with app.app_context():
+    INDEX_HTML = render_template_string(HTML, num_leds=NUM_LEDS)
+INDEX_GZ = gzip.compress(INDEX_HTML.encode())
+INDEX_ETAG = hashlib.sha1(INDEX_HTML.encode()).hexdigest()[:16]
+
 # -----------------------------
 # Startup
 # -----------------------------
 if __name__ == "__main__":
     load_state()
+    warm_up(NUM_LEDS, RED, ORANGE, SCALE)
+    threading.Thread(target=state_flusher, daemon=True).start()
+    threading.Thread(target=led_actor, daemon=True).start()
     # startup plug-check (2s), then restore
-    run_show_and_restore(light_display_2s)
+    queue_show(light_display_2s)
     app.run(host="0.0.0.0", port=5000)
 
 